@@ -1,27 +1,52 @@
 import os
+import re
 import sys
+import json
 import shutil
 import fnmatch
+import operator
 import itertools
 import argparse
 import getpass
+import hashlib
+import threading
 import requests
 import urllib.parse
-from xml.dom import minidom
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from xml.etree import ElementTree
 from tqdm import tqdm
     
 
-PROPFIND_REQUEST = '''<?xml version="1.0" encoding="UTF-8"?>
+PROPFIND_REQUEST = b'''<?xml version="1.0" encoding="UTF-8"?>
 <d:propfind xmlns:d="DAV:">
     <d:prop xmlns:oc="http://owncloud.org/ns">
         <d:getlastmodified/>
         <d:getcontentlength/>
         <d:getcontenttype/>
+        <d:getetag/>
     </d:prop>
 </d:propfind>'''
 
 CODE_SUCCESS  = 207
+CODE_OK       = 200
+CODE_PARTIAL  = 206
+CODES_DEPTH_REFUSED = (403, 412)
 LEN_PATH_PREF = len('/public.php/webdav')
+DAV_NS        = '{DAV:}'
+PROP_FIELDS   = {f'{DAV_NS}get{field}': field for field in ['lastmodified', 'contentlength', 'contenttype', 'etag']}
+
+BLOCK_SIZE        = 1 << 20
+WRITE_BUFFER_SIZE = 4 << 20
+RANGE_THRESHOLD   = 16 << 20
+RANGE_CONNECTIONS = 6
+
+STATE_FILE = '.nc_share_state.jsonl'
+PART_DIR   = '.nc_share_parts'
+
+# KeyboardInterrupt only reaches the main thread, this tells the download threads to give up
+interrupted = threading.Event()
 
 
 def parse_args():
@@ -33,7 +58,13 @@ def parse_args():
     parser.add_argument('-o', '--output', help="Output dir.", default='.')
     parser.add_argument('-R', '--resume', help="Resume download.", action="store_true", default=False)
     parser.add_argument('-g', '--glob', help="Glob pattern for filtering files by their name.", action='append')
+    parser.add_argument('-j', '--jobs', help="Number of files downloaded in parallel.", type=int, default=8)
+    parser.add_argument('--cache-dir', help="Dir for caching share listings.", default=os.path.join('~', '.cache', 'nc_share'))
+    parser.add_argument('--no-cache', help="Always list the share instead of using a cached listing.", action="store_true", default=False)
     parsed_args = parser.parse_args()
+    parsed_args.jobs = max(parsed_args.jobs, 1)
+    # local files are looked up by the paths os.scandir builds, which are only equal for a normalised output dir
+    parsed_args.output = os.path.normpath(parsed_args.output)
     return parsed_args
 
 
@@ -84,40 +115,107 @@ def sizeof_fmt(num, suffix="B"):
     return f"{num:.1f}Yi{suffix}"
 
 
-def parse_propfind_response(text):
-    dom = minidom.parseString(text.encode('ascii', 'xmlcharrefreplace'))
+def parse_propfind_response(stream):
     res = []
-    for response in dom.getElementsByTagName('d:response'):
+    root = None
+    for event, response in ElementTree.iterparse(stream, events=('start', 'end')):
+        if root is None:
+            root = response
+        if event != 'end' or response.tag != f'{DAV_NS}response':
+            continue
         item = {
-            'path': response.getElementsByTagName(f'd:href')[0].firstChild.data[LEN_PATH_PREF:],
+            'path': response.findtext(f'{DAV_NS}href')[LEN_PATH_PREF:],
         }
-        for field in ['lastmodified', 'contentlength', 'contenttype']:
-            node = response.getElementsByTagName(f'd:get{field}')[0].firstChild
-            if node:
-                item[field] = node.data
+        # visit each property once instead of searching the subtree for every field
+        for prop in response.iterfind(f'{DAV_NS}propstat/{DAV_NS}prop/*'):
+            if prop.text and prop.tag in PROP_FIELDS:
+                item[PROP_FIELDS[prop.tag]] = prop.text
         if 'contentlength' in item:
             item['contentlength'] = int(item['contentlength'])
+        # detach the parsed response from the tree, the item holds everything we need
+        root.remove(response)
         res.append(item)
     return res
 
 
-def list_dir(session, host, path):
+class DepthInfinityRefused(RuntimeError):
+    pass
+
+
+def propfind(session, host, path, depth=None):
     url = f'{host}/public.php/webdav/{path}'
-    r = session.request(method='PROPFIND', url=url, data=PROPFIND_REQUEST)
-    if r.status_code != CODE_SUCCESS:
-        raise RuntimeError(f'Unexpected response from {url}\n Status code: {r.status_code}\n Message:\n{r.text}')
-    
+    # the session sends `Depth: 1`, only override it when asked to
+    headers = {'Depth': depth} if depth else None
+    # parse the body while it arrives instead of buffering large listings in memory first
+    with session.request(method='PROPFIND', url=url, data=PROPFIND_REQUEST, headers=headers, stream=True) as r:
+        if depth == 'infinity' and r.status_code in CODES_DEPTH_REFUSED:
+            raise DepthInfinityRefused(f'Server refused infinite-depth listing of {url}')
+        if r.status_code != CODE_SUCCESS:
+            raise RuntimeError(f'Unexpected response from {url}\n Status code: {r.status_code}\n Message:\n{r.text}')
+        r.raw.decode_content = True
+        return parse_propfind_response(r.raw)
+
+
+def list_dir(session, host, path, depth=None):
     # the first element is the current dir specified by `path`, skip it 
-    return parse_propfind_response(r.text)[1:]
+    return propfind(session, host, path, depth=depth)[1:]
 
 
-def walk_dir(session, host, path):
+def walk_dirs(session, host, dirs, jobs=8):
+    # list dirs concurrently, queueing each subdir as soon as its parent's listing arrives
     files = []
-    for x in list_dir(session, host, path):
-        if x['path'].endswith('/'):
-            files += walk_dir(session, host, x['path'])
-        else:
-            files.append(x)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(list_dir, session, host, d) for d in dirs}
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                for x in future.result():
+                    if x['path'].endswith('/'):
+                        pending.add(executor.submit(list_dir, session, host, x['path']))
+                    else:
+                        files.append(x)
+    return files
+
+
+def walk_dir(session, host, path, jobs=8):
+    # a single infinite-depth PROPFIND returns the whole tree, but servers may refuse it
+    try:
+        items = list_dir(session, host, path, depth='infinity')
+    except DepthInfinityRefused:
+        return walk_dirs(session, host, [path], jobs=jobs)
+
+    # Sabre-based servers with infinite depth disabled silently answer with depth 1 instead,
+    # so every dir without any entry in the reply is listed separately (empty dirs included)
+    parents = {x['path'].rstrip('/').rsplit('/', 1)[0] + '/' for x in items}
+    unlisted = [x['path'] for x in items if x['path'].endswith('/') and x['path'] not in parents]
+    files = [x for x in items if not x['path'].endswith('/')]
+    return files + walk_dirs(session, host, unlisted, jobs=jobs)
+
+
+def walk_dir_cached(session, host, path, cache_file, jobs=8):
+    # the etag of a dir changes whenever anything below it does, so a cached listing stays valid while it matches
+    root = propfind(session, host, path, depth='0')[0]
+    version = root.get('etag') or root.get('lastmodified')
+    if version is None:
+        return walk_dir(session, host, path, jobs=jobs)
+
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if isinstance(cached, dict) and cached['version'] == version and isinstance(cached['files'], list):
+            return cached['files']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    files = walk_dir(session, host, path, jobs=jobs)
+    # the cache is only an optimisation, an unwritable cache dir must not fail the run
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(f'{cache_file}.tmp', 'w') as f:
+            json.dump({'version': version, 'files': files}, f)
+        os.replace(f'{cache_file}.tmp', cache_file)
+    except OSError:
+        pass
     return files
 
 
@@ -125,82 +223,293 @@ def check_dir_not_empty(path):
     return os.path.isdir(path) and os.listdir(path)
 
 
-def glob_filter(path, globs):
-    for g in globs:
-        if fnmatch.fnmatch(path, g):
-            return True
-    return False
+def compile_globs(globs):
+    # a single alternation matches a path against all globs in one pass
+    return re.compile('|'.join(f'(?:{fnmatch.translate(g)})' for g in globs))
     
 
-def check_files(files):
+def scan_files(dirs):
+    # one scandir per directory instead of stat-ing every listed file separately,
+    # entries are kept so that files can be stat-ed only when their size is needed
+    files = {}
+    for d in dirs:
+        try:
+            with os.scandir(d) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        files[entry.path] = entry
+        except OSError:
+            # missing or unreadable, same as a dir without files
+            pass
+    return files
+
+
+def load_state(path):
+    # maps share paths to their latest record, which holds the `validator` of a started download
+    # and the `size` of a completed one
+    state = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    x = json.loads(line)
+                    state[x['path']] = x
+                except (ValueError, KeyError, TypeError):
+                    pass
+    except FileNotFoundError:
+        pass
+    return state
+
+
+def compact_state(path):
+    # keep only the latest record per file so the state does not grow with every run
+    state = load_state(path)
+    if not state:
+        return
+    with open(f'{path}.tmp', 'w') as f:
+        f.writelines(json.dumps(x) + '\n' for x in state.values())
+    os.replace(f'{path}.tmp', path)
+
+
+def check_files(files, local_files, state):
     new = []
+    partial = []
     existing = []
     mismatched = []
     for x in files:
-        if os.path.isfile(x['dest']):
-            x['filesize'] = os.path.getsize(x['dest'])
+        record = state.get(x['path'], {})
+        entry = local_files.get(x['dest'])
+        if entry is not None:
+            if record.get('size') == x['contentlength']:
+                # completed by an earlier run, no need to stat it
+                existing.append(x)
+                continue
+            x['filesize'] = entry.stat().st_size
             if x['filesize'] == x['contentlength']:
                 existing.append(x)
-            else:
-                mismatched.append(x)
+                continue
+
+        # unfinished downloads live in a part file that is cut back to its valid prefix on failure,
+        # one at full size was preallocated by a killed download and its content is unknown;
+        # without the validator the download started with, a changed remote file could not be detected
+        part = local_files.get(x['part'])
+        if part is not None and record.get('validator'):
+            part_size = part.stat().st_size
+            if part_size < x['contentlength']:
+                x['filesize'] = x['start_offset'] = part_size
+                x['resume_validator'] = record['validator']
+                partial.append(x)
+                continue
+
+        if entry is not None:
+            mismatched.append(x)
         else:
             new.append(x)
-    return new, mismatched, existing
+    return new, partial, mismatched, existing
 
 
 def get_file_lists(session, host_url, path, args):
-    files = sorted(walk_dir(session, host_url, path), key=lambda x: x['path'])
+    if args.no_cache:
+        files = walk_dir(session, host_url, path, jobs=args.jobs)
+    else:
+        cache_file = os.path.join(os.path.expanduser(args.cache_dir), hashlib.sha1(args.url.encode()).hexdigest() + '.json')
+        files = walk_dir_cached(session, host_url, path, cache_file, jobs=args.jobs)
+    files = sorted(files, key=lambda x: x['path'])
     
+    part_dir = os.path.join(args.output, PART_DIR)
     for x in files:
-        x['dest'] = urllib.parse.unquote(os.path.join(args.output, x['path'][1:]))
+        dest = os.path.join(args.output, x['path'][1:])
+        x['dest'] = urllib.parse.unquote(dest) if '%' in dest else dest
+        # part files are named after the share path so they can never be mistaken for a file of the share
+        x['part'] = os.path.join(part_dir, hashlib.sha1(x['path'].encode()).hexdigest())
 
     if args.glob:
         print('Filtering by matching file paths to:', args.glob)
-        files = [x for x in files if glob_filter(x['dest'], args.glob)]
+        pattern = compile_globs(args.glob)
+        files = [x for x in files if pattern.match(x['dest'])]
+
+    for x in files:
+        top = urllib.parse.unquote(x['path'][1:]).split('/', 1)[0]
+        if top in (PART_DIR, STATE_FILE):
+            raise RuntimeError(f'The share contains `{top}`, which clashes with the download state kept in the output dir.')
     
     if check_dir_not_empty(args.output):
-        new_files, mismatched, existing = check_files(files)
+        state = load_state(os.path.join(args.output, STATE_FILE))
+        dirs = {os.path.dirname(x['dest']) for x in files} | {part_dir}
+        new_files, partial, mismatched, existing = check_files(files, scan_files(dirs), state)
     else:
-        new_files, mismatched, existing = files, [], []
+        new_files, partial, mismatched, existing = files, [], [], []
+
+    return new_files, partial, mismatched, existing
+
+
+def preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # not available on this platform or filesystem (ZFS, NFS, FUSE, ...), a sparse file of the right size will do
+        os.ftruncate(fd, size)
+
+
+def range_validator(x):
+    # If-Range only accepts strong etags and dates
+    etag = x.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return x.get('lastmodified')
+
+
+def range_headers(lo, hi='', if_range=None):
+    headers = {'Range': f'bytes={lo}-{hi}'}
+    if if_range:
+        # the server answers with the whole file instead if it no longer matches `if_range`
+        headers['If-Range'] = if_range
+    return headers
 
-    return new_files, mismatched, existing
 
+def read_blocks(response):
+    """Yield the body of a streamed `response` as views of one reused buffer.
 
-def download_file(session, host, path_share, path_out, desc_len=100, desc_pref=''):
+    Each view is only valid until the next one is requested.
+    """
+    response.raw.decode_content = True
+    buffer = bytearray(BLOCK_SIZE)
+    view = memoryview(buffer)
+    while n := response.raw.readinto(buffer):
+        if interrupted.is_set():
+            raise KeyboardInterrupt
+        yield view[:n]
+
+
+def download_ranges(session, url, path_out, size, start_offset, if_range, desc):
+    """Download bytes `start_offset` to `size` of `url` over RANGE_CONNECTIONS parallel range requests.
+
+    Returns False without touching `path_out` if the server does not honour range requests.
+    """
+    step = -(-(size - start_offset) // RANGE_CONNECTIONS)
+    ranges = [(lo, min(lo + step, size)) for lo in range(start_offset, size, step)]
+
+    first = session.get(url, headers=range_headers(start_offset, ranges[0][1] - 1, if_range), stream=True)
+    if first.status_code != CODE_PARTIAL:
+        first.close()
+        return False
+
+    done = [0] * len(ranges)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def fetch(i, response=None):
+        lo, hi = ranges[i]
+        if response is None:
+            if stop.is_set() or interrupted.is_set():
+                return
+            response = session.get(url, headers=range_headers(lo, hi - 1, if_range), stream=True)
+        with response:
+            if response.status_code != CODE_PARTIAL:
+                raise RuntimeError(f"Unexpected response to range request: {url}\n Status code: {response.status_code}")
+            for block in read_blocks(response):
+                if stop.is_set():
+                    return
+                os.pwrite(fd, block, lo + done[i])
+                done[i] += len(block)
+                with lock:
+                    progress_bar.update(len(block))
+        if done[i] != hi - lo:
+            raise RuntimeError(f"Could not download file: {url}")
+
+    fd = os.open(path_out, os.O_WRONLY | os.O_CREAT | (0 if start_offset else os.O_TRUNC), 0o666)
+    try:
+        preallocate(fd, size)
+        with tqdm(total=size, initial=start_offset, unit="B", unit_scale=True, desc=desc) as progress_bar:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(fetch, 0, first)]
+                futures += [executor.submit(fetch, i) for i in range(1, len(ranges))]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    stop.set()
+                    raise
+    except BaseException:
+        # cut the file back to its contiguous prefix so that the download can be resumed from its size
+        prefix = start_offset
+        for (lo, hi), n in zip(ranges, done):
+            prefix = lo + n
+            if prefix < hi:
+                break
+        os.ftruncate(fd, prefix)
+        raise
+    finally:
+        os.close(fd)
+    return True
+
+
+def download_file(session, host, path_share, path_out, path_part, size=0, start_offset=0, if_range=None, desc_len=100, desc_pref=''):
     url = f'{host}/public.php/webdav/{path_share}'
     os.makedirs(os.path.dirname(path_out), exist_ok=True)
-    
-    response = session.get(url, stream=True)
-    total_size = int(response.headers.get("content-length", 0))
-    block_size = 1024
+    os.makedirs(os.path.dirname(path_part), exist_ok=True)
+    desc = path_fmt(path_share, desc_len=desc_len, desc_pref=desc_pref)
 
-    with tqdm(total=total_size, unit="B", unit_scale=True, desc=path_fmt(path_share, desc_len=desc_len, desc_pref=desc_pref)) as progress_bar:
-        with open(path_out, "wb") as file:
-            for data in response.iter_content(block_size):
-                progress_bar.update(len(data))
-                file.write(data)
+    # data goes to `path_part` which only replaces `path_out` once complete
+    if size - start_offset >= RANGE_THRESHOLD and download_ranges(session, url, path_part, size, start_offset, if_range, desc):
+        os.replace(path_part, path_out)
+        return
 
-    if total_size != 0 and progress_bar.n != total_size:
+    headers = range_headers(start_offset, if_range=if_range) if start_offset else None
+    response = session.get(url, headers=headers, stream=True)
+    if response.status_code not in (CODE_OK, CODE_PARTIAL):
+        response.close()
+        raise RuntimeError(f'Unexpected response from {url}\n Status code: {response.status_code}')
+    if response.status_code != CODE_PARTIAL:
+        # the server sends the whole file because it ignores ranges or the file changed, start over
+        start_offset = 0
+    content_length = int(response.headers.get("content-length", 0))
+    total_size = start_offset + content_length
+
+    with tqdm(total=total_size, initial=start_offset, unit="B", unit_scale=True, desc=desc) as progress_bar:
+        fd = os.open(path_part, os.O_WRONLY | os.O_CREAT | (0 if start_offset else os.O_TRUNC), 0o666)
+        with os.fdopen(fd, "wb", buffering=WRITE_BUFFER_SIZE) as file:
+            if content_length:
+                preallocate(fd, total_size)
+            file.seek(start_offset)
+            try:
+                for block in read_blocks(response):
+                    file.write(block)
+                    progress_bar.update(len(block))
+            finally:
+                # drop the unwritten part of the preallocation so the download can be resumed from its size
+                file.truncate()
+
+    if content_length != 0 and progress_bar.n != total_size:
         raise RuntimeError(f"Could not download file: {url}")
+    if size and progress_bar.n != size:
+        raise RuntimeError(f"Could not download file: {url}\n Received {progress_bar.n} bytes, the share lists {size}")
+    os.replace(path_part, path_out)
 
 
-def print_share_contents(new_files, mismatched, existing, path_len=100):
-    if existing:
-        print('\nExisting files:\n---------------')
-        for x in existing:
-            print(f"{path_fmt(x['path'], desc_len=path_len)} {sizeof_fmt(x['contentlength']):<12} {x['lastmodified']:<34} {x['contenttype']:<40}")
+def file_row(x, path_len):
+    return f"{path_fmt(x['path'], desc_len=path_len)} {sizeof_fmt(x['contentlength']):<12} {x['lastmodified']:<34} {x['contenttype']:<40}"
 
-    if new_files:
-        print('\nNew files:\n----------')
-        for x in new_files:
-            print(f"{path_fmt(x['path'], desc_len=path_len)} {sizeof_fmt(x['contentlength']):<12} {x['lastmodified']:<34} {x['contenttype']:<40}")
-    
-    if mismatched:
-        print('\nFiles with unexpected size:\n---------------------------')
-        for x in mismatched:
-            size_str = f"{sizeof_fmt(x['filesize'])} / {sizeof_fmt(x['contentlength'])}"
-            print(f"{path_fmt(x['path'], desc_len=path_len-8)} {size_str:<20} {x['lastmodified']:<34} {x['contenttype']:<40}")
-    print()
+
+def size_mismatch_row(x, path_len):
+    size_str = f"{sizeof_fmt(x['filesize'])} / {sizeof_fmt(x['contentlength'])}"
+    return f"{path_fmt(x['path'], desc_len=path_len-8)} {size_str:<20} {x['lastmodified']:<34} {x['contenttype']:<40}"
+
+
+def print_share_contents(new_files, partial, mismatched, existing, path_len=100):
+    sections = [
+        ('Existing files', existing, file_row),
+        ('New files', new_files, file_row),
+        ('Partially downloaded files', partial, size_mismatch_row),
+        ('Files with unexpected size', mismatched, size_mismatch_row),
+    ]
+    # collect everything first and write it at once, large shares list thousands of rows
+    lines = []
+    for title, files, row in sections:
+        if files:
+            lines += ['', f'{title}:', '-' * (len(title) + 1)]
+            lines += [row(x, path_len) for x in files]
+    sys.stdout.write('\n'.join(lines + ['', '']))
 
 
 def main():
@@ -223,16 +532,23 @@ def main():
 
     s = requests.Session()
     s.auth = token, pw
+    s.headers.update({'Content-Type': 'application/xml; charset=utf-8', 'Depth': '1'})
+    # every download may hold up to RANGE_CONNECTIONS connections, keep them all alive for reuse
+    retries = Retry(total=5, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=['HEAD', 'GET', 'PROPFIND'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=args.jobs * RANGE_CONNECTIONS, max_retries=retries)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
 
     print('Reading share contents.')
-    new_files, mismatched, existing = get_file_lists(s, host_url, path, args)
+    new_files, partial, mismatched, existing = get_file_lists(s, host_url, path, args)
 
-    print_share_contents(new_files, mismatched, existing, path_len=desc_len)
+    print_share_contents(new_files, partial, mismatched, existing, path_len=desc_len)
     
-    total = sum(x['contentlength'] for x in itertools.chain(new_files, mismatched))
-    print(f'{len(new_files)} new file(s) will be downloaded and {len(mismatched)} overwritten. Total size: {sizeof_fmt(total)}')
+    total = sum(map(operator.itemgetter('contentlength'), itertools.chain(new_files, partial, mismatched)))
+    total -= sum(map(operator.itemgetter('start_offset'), partial))
+    print(f'{len(new_files)} new file(s) will be downloaded, {len(partial)} resumed and {len(mismatched)} overwritten. Total size: {sizeof_fmt(total)}')
 
-    n_download = len(new_files) + len(mismatched)
+    n_download = len(new_files) + len(partial) + len(mismatched)
     if n_download == 0:
         print('Nothing to download. Exiting.')
         return
@@ -241,8 +557,45 @@ def main():
         print('Aborted.')
         return
 
-    for i, x in enumerate(itertools.chain(mismatched, new_files), start=1):
-        download_file(s, host_url, x['path'], x['dest'], desc_len=desc_len, desc_pref=f'[{i}/{n_download}] ')
+    os.makedirs(args.output, exist_ok=True)
+    state_lock = threading.Lock()
+
+    def record(entry):
+        with state_lock:
+            state_file.write(json.dumps(entry) + '\n')
+            state_file.flush()
+
+    def download(item):
+        i, x = item
+        # remember which version of the file is being downloaded so that resuming can tell if it changed
+        validator = range_validator(x)
+        record({'path': x['path'], 'validator': validator})
+        download_file(s, host_url, x['path'], x['dest'], x['part'], size=x['contentlength'], start_offset=x.get('start_offset', 0),
+                      if_range=x.get('resume_validator', validator), desc_len=desc_len, desc_pref=f'[{i}/{n_download}] ')
+        # download_file has checked the status and the received size, record the file as complete right away
+        # so an interrupted run can be resumed without re-checking it
+        record({'path': x['path'], 'size': x['contentlength']})
+
+    state_path = os.path.join(args.output, STATE_FILE)
+    compact_state(state_path)
+
+    # tqdm assigns each concurrent progress bar its own line
+    with open(state_path, 'a') as state_file:
+        executor = ThreadPoolExecutor(max_workers=args.jobs)
+        try:
+            list(executor.map(download, enumerate(itertools.chain(mismatched, partial, new_files), start=1)))
+        except KeyboardInterrupt:
+            # let running downloads clean up after themselves and drop the queued ones
+            interrupted.set()
+            executor.shutdown(cancel_futures=True)
+            print('\nInterrupted. Run again with `--resume` to continue the download.')
+        finally:
+            executor.shutdown()
+            # only kept while it holds unfinished downloads
+            try:
+                os.rmdir(os.path.join(args.output, PART_DIR))
+            except OSError:
+                pass
 
 
 if __name__ == '__main__':